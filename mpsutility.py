@@ -55,10 +55,23 @@
 #############################################################################
 
 import requests
+import calendar
+import collections
+import concurrent.futures
+import contextlib
+import cProfile
+import csv
+import http.server
+import io
 import json
+import math
 import os
+import pstats
+import sqlite3
 import sys
+import threading
 import time
+import tracemalloc
 import uuid
 
 #############################################################################
@@ -83,6 +96,70 @@ headers = {
 #title id configured in mpsutility.cfg and populated at start of main loop
 title_id = ""
 
+#shared HTTP session so API calls reuse pooled keep-alive connections across threads
+poolSize = 64
+httpSession = requests.Session()
+httpSession.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=poolSize))
+
+#titles configured under "titles" in mpsutility.json, keyed by name; each has its own headers, auth token,
+#connection pool, rate limit and cache. activeTitle.Title selects one for API calls made on the current thread
+titles = {}
+activeTitle = threading.local()
+
+#option flags (--name or --name=value) removed from the command line by initOptionFlags
+options = {}
+
+#profiling state populated by --profile[=file] and --trace=file; spans are (name, category, start, duration, thread)
+#'Busy' is set while an operation is profiled; operations started inside it (e.g. once per title) only add spans
+#spans are handed to the report & trace after each operation; 'TraceStarted' is set once the trace file is created
+profiling = {'Enabled': False, 'File': 'mpsutility.profile.txt', 'Trace': None, 'Spans': [], 'Origin': 0.0,
+             'Lock': threading.Lock(), 'Busy': False, 'TraceStarted': False}
+profileSpanLimit = 1000000      #spans kept per operation; later spans are dropped to bound memory on long runs
+nullSpan = contextlib.nullcontext()
+
+#live metrics served at /metrics in OpenMetrics text format when --metrics[=[host:]port] is given
+metricsBuckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+metricsRateWindow = 10          #seconds of completed requests averaged into mps_requests_per_second
+metrics = {'Enabled': False, 'Lock': threading.Lock(), 'InFlight': 0, 'Requests': {}, 'Durations': {},
+           'Recent': collections.deque(), 'Batch': 0, 'BatchSize': 0, 'Ramp': 0, 'Allocations': {}, 'Lag': 0.0}
+
+#allocation scheduler defaults; batch N is due N * pause seconds after the run starts, whatever earlier batches took
+#override with --workers, --timeout, --tolerance, --late and --report (or plan allocate arguments)
+allocateWorkers = 16        #concurrent allocation requests
+allocateTimeout = 10.0      #seconds to connect or wait for a response before an allocation times out
+allocateTolerance = 5.0     #seconds past its due time an allocation may start before it is late
+allocateLatePolicy = 'flag' #'flag' sends late allocations and counts them, 'shed' drops them unsent
+allocateLatePolicies = ['flag', 'shed']
+allocateOutcomes = ['Scheduled', 'Sent', 'Completed', 'Failed', 'TimedOut', 'Late', 'Shed']
+
+#server summaries shared by plan steps polling the same build & region; entries are (fetched, summaries)
+summaryCache = {'Lock': threading.Lock(), 'Locks': {}, 'Entries': {}}
+
+#snapshot store populated by --store[=file]; every full VM or server listing is appended under the current run
+store = {'Connection': None, 'Lock': threading.Lock(), 'File': 'mpsutility.db', 'Run': ''}
+
+#command line operations that run without PlayFab configuration or authentication
+offlineOperations = ['query']
+
+#interactive prefetch; a background thread refreshes builds plus VMs & servers of recent build & region selections
+prefetchInterval = 20       #seconds between background refreshes
+prefetchMaxAge = 30         #prefetched lists older than this are fetched again when a menu needs them
+prefetchRecent = 4          #build & region selections kept warm
+#'Paused' is set by the menu loop while an operation runs; a refresh in progress stops at its next request
+prefetch = {'Lock': threading.Lock(), 'Paused': threading.Event(), 'Wake': threading.Event(), 'Selections': [], 'Entries': {}}
+
+#columns written by the inventory operation; list values are JSON encoded in CSV output
+inventoryFields = ['SessionId', 'ServerId', 'BuildId', 'Region', 'State', 'VmId', 'IPV4Address', 'FQDN',
+                   'Ports', 'ConnectedPlayers']
+
+#autoscale tuning; lead time is the seconds of allocation demand the standby pool should absorb
+autoscaleLeadTime = 120
+autoscaleSmoothing = 0.3        #weight of the latest allocation rate sample (exponential moving average)
+autoscaleHysteresis = 0.1       #fraction of current standby a new target must differ by before updating
+autoscaleCooldown = 30          #minimum seconds between standby increases
+autoscaleCooldownDown = 180     #minimum seconds between standby decreases
+autoscaleMaxStep = 100          #maximum standby change per update
+
 #############################################################################
 # MPS Utility Handlers
 #############################################################################
@@ -109,7 +186,7 @@ def ListBuildSettings(debug):
             regLength = len(regionslist)
             build['RegionsLength']=regLength
             buildlist.append(build)
-            mps['builds']=buildlist
+        GetTitleCache()['builds']=buildlist     #publish only the complete list; menus may be reading the old one
         return True
     else:
         return False
@@ -117,58 +194,131 @@ def ListBuildSettings(debug):
 # Lists MPS VM settings; calls MultiplayerServer/ListVirtualMachineSummaries
 def ListVirtualMachines(appchoice, debug=0):
 
+    vmlist = FetchVirtualMachineList(appchoice, debug)
+
+    if vmlist != None:
+        GetTitleCache()['vms']=vmlist
+        return True
+    else:
+        return False
+
+# Returns the first page of MPS VMs (VmId, State, HealthStatus), or None on failure
+def FetchVirtualMachineList(appchoice, debug=0):
+
     method = "MultiplayerServer/ListVirtualMachineSummaries"
     data = {'BuildId': appchoice['BuildId'], 'Region': appchoice['Region'], 'PageSize': '10'}
     resp = MPSAPIHandler(method, headers, data, debug)
 
-    if resp['code'] == 200:
-        vmlist=[]
-        for x in resp['data']['VirtualMachines']:
-            vm = {}
+    if resp['code'] != 200:
+        return None
 
-            vm['VmId'] = x['VmId']
-            vm['State'] = x['State']
-            vm['HealthStatus'] = x['HealthStatus']
-                
-            vmlist.append(vm)
-            mps['vms']=vmlist
+    vmlist=[]
+    for x in resp['data']['VirtualMachines']:
+        vm = {}
+
+        vm['VmId'] = x['VmId']
+        vm['State'] = x['State']
+        vm['HealthStatus'] = x['HealthStatus']
+            
+        vmlist.append(vm)
+    return vmlist
+
+# Lists MPS servers (standby & active); calls MultiplayerServer/ListMultiplayerServers
+def ListMultiplayerServers(appchoice, debug=0):
+
+    serverlist = FetchServerList(appchoice, debug)
+
+    if serverlist != None:
+        GetTitleCache()['servers']=serverlist
         return True
     else:
         return False
 
-# Lists MPS servers (standby & active); calls MultiplayerServer/ListMultiplayerServers
-def ListMultiplayerServers(appchoice, debug=0):
+# Returns the first page of MPS servers as shown in session menus, or None on failure
+def FetchServerList(appchoice, debug=0):
 
     method = "MultiplayerServer/ListMultiplayerServers"
     data = {'BuildId': appchoice['BuildId'], 'Region': appchoice['Region'] ,'PageSize': 100}
     resp = MPSAPIHandler(method, headers, data, debug)
 
-    if resp['code'] == 200:
-        serverlist=[]
-        for x in resp['data']['MultiplayerServerSummaries']:
-            server = {}
-
-            server['ServerId'] = x['ServerId']
-            server['VmId']     = x['VmId']
-            server['Region']   = x['Region']
-            server['State']    = x['State']
-            server['ConnectedPlayers'] = x['ConnectedPlayers']
-            server['LastStateTransitionTime'] = x['LastStateTransitionTime']
-
-            if 'SessionId' in x:
-                server['SessionId'] = x['SessionId']
-
-            serverlist.append(server)
-        mps['servers']=serverlist
+    if resp['code'] != 200:
+        return None
+
+    serverlist=[]
+    for x in resp['data']['MultiplayerServerSummaries']:
+        server = {}
+
+        server['ServerId'] = x['ServerId']
+        server['VmId']     = x['VmId']
+        server['Region']   = x['Region']
+        server['State']    = x['State']
+        server['ConnectedPlayers'] = x['ConnectedPlayers']
+        server['LastStateTransitionTime'] = x['LastStateTransitionTime']
+
+        if 'SessionId' in x:
+            server['SessionId'] = x['SessionId']
+
+        serverlist.append(server)
+    return serverlist
+
+# Lists all MPS server summaries across pages; calls MultiplayerServer/ListMultiplayerServers
+# Optional pageHandler is called with each page of summaries as it arrives; pages are then streamed rather
+# than collected and True is returned on success (no snapshot is recorded). Returns None on failure
+def ListMultiplayerServerSummaries(appchoice, debug=0, pageHandler=None):
+
+    method = "MultiplayerServer/ListMultiplayerServers"
+    data = {'BuildId': appchoice['BuildId'], 'Region': appchoice['Region'], 'PageSize': 120}
+    summaries = []
+
+    while True:
+        resp = MPSAPIHandler(method, headers, data, debug)
+        if resp['code'] != 200:
+            print(json.dumps(resp, sort_keys=False, indent=4))
+            return None
+
+        page = resp['data']['MultiplayerServerSummaries']
+        if pageHandler != None:
+            pageHandler(page)
+        else:
+            summaries.extend(page)
+
+        if not resp['data'].get('SkipToken'):
+            break
+        data['SkipToken'] = resp['data']['SkipToken']
+
+    if pageHandler != None:
         return True
-    else:
-        return False
+
+    RecordSnapshot('servers', appchoice, summaries)
+    return summaries
+
+# Lists all MPS VM summaries across pages; calls MultiplayerServer/ListVirtualMachineSummaries
+def ListVirtualMachineSummaries(appchoice, debug=0):
+
+    method = "MultiplayerServer/ListVirtualMachineSummaries"
+    data = {'BuildId': appchoice['BuildId'], 'Region': appchoice['Region'], 'PageSize': 120}
+    summaries = []
+
+    while True:
+        resp = MPSAPIHandler(method, headers, data, debug)
+        if resp['code'] != 200:
+            print(json.dumps(resp, sort_keys=False, indent=4))
+            return None
+
+        summaries.extend(resp['data']['VirtualMachines'])
+
+        if not resp['data'].get('SkipToken'):
+            break
+        data['SkipToken'] = resp['data']['SkipToken']
+
+    RecordSnapshot('vms', appchoice, summaries)
+    return summaries
 
 # Lists MPS server connection details (FQDN, IP, Ports, etc.); calls MultiplayerServer/GetMultiplayerServerDetails
 def GetMultiplayerServerDetails(appchoice, debug=0):
 
     #Cache Multiplayer Servers Results with Session IDs
-    ListMultiplayerServers(appchoice, debug)
+    LoadSessionServers(appchoice, debug)
 
     #Get Multiplayer Server Details of a given Session ID
     status = GetSessionSelection(appchoice)
@@ -178,25 +328,9 @@ def GetMultiplayerServerDetails(appchoice, debug=0):
     if 'SessionId' not in appchoice:
         return False
         
-    method = "MultiplayerServer/GetMultiplayerServerDetails"
-    data = {'BuildId': appchoice['BuildId'], 'SessionId': appchoice['SessionId'], 'Region':  appchoice['Region']  }
-    resp = MPSAPIHandler(method, headers, data, debug)
-
-    if resp['code'] == 200:
+    serverDetails = FetchMultiplayerServerDetails(appchoice, appchoice['SessionId'], debug)
 
-        serverDetails={}
-
-        serverDetails['SessionId']         = resp['data']['SessionId']
-        serverDetails['ServerId']          = resp['data']['ServerId']
-        serverDetails['IPV4Address']       = resp['data']['IPV4Address']
-        serverDetails['VmId']              = resp['data']['VmId']
-        serverDetails['FQDN']              = resp['data']['FQDN']
-        serverDetails['Region']            = resp['data']['Region']
-        serverDetails['State']             = resp['data']['State']
-        serverDetails['BuildId']           = resp['data']['BuildId']
-        serverDetails['Ports']             = resp['data']['Ports']
-        serverDetails['ConnectedPlayers']  = resp['data']['ConnectedPlayers']
-                   
+    if serverDetails != None:
         mps['serverdetails'] = serverDetails
         
         print(json.dumps(mps['serverdetails'], sort_keys=False, indent=4))
@@ -205,10 +339,104 @@ def GetMultiplayerServerDetails(appchoice, debug=0):
     else:
         return False
 
+# Returns connection details for one session, or None on failure; calls MultiplayerServer/GetMultiplayerServerDetails
+def FetchMultiplayerServerDetails(appchoice, sessionId, debug=0):
+
+    method = "MultiplayerServer/GetMultiplayerServerDetails"
+    data = {'BuildId': appchoice['BuildId'], 'SessionId': sessionId, 'Region':  appchoice['Region']  }
+    resp = MPSAPIHandler(method, headers, data, debug)
+
+    if resp['code'] != 200:
+        print("Session {} details failed: {} {}".format(sessionId, resp['code'], resp.get('errorMessage', resp.get('status', ''))))
+        return None
+
+    serverDetails={}
+
+    serverDetails['SessionId']         = resp['data']['SessionId']
+    serverDetails['ServerId']          = resp['data']['ServerId']
+    serverDetails['IPV4Address']       = resp['data']['IPV4Address']
+    serverDetails['VmId']              = resp['data']['VmId']
+    serverDetails['FQDN']              = resp['data']['FQDN']
+    serverDetails['Region']            = resp['data']['Region']
+    serverDetails['State']             = resp['data']['State']
+    serverDetails['BuildId']           = resp['data']['BuildId']
+    serverDetails['Ports']             = resp['data']['Ports']
+    serverDetails['ConnectedPlayers']  = resp['data']['ConnectedPlayers']
+
+    return serverDetails
+
+# Exports connection details of every active session to CSV, or NDJSON when outfile ends in .ndjson/.jsonl
+# Sessions are listed page by page while a bounded worker pool fetches details; rows stream out as they complete
+def InventoryHandler(appchoice, debug=0):
+
+    outfile = appchoice['OutFile']
+    workers = appchoice['Workers']
+    ndjson = outfile.lower().endswith(('.ndjson', '.jsonl'))
+    inventory = {'Listed': 0, 'Exported': 0, 'Failed': 0}
+    pending = {}        #future -> session id
+
+    try:
+        fhand = open(outfile, "w", newline='')
+    except OSError as err:
+        print("Unable to open {}: {}".format(outfile, err))
+        return False
+
+    #closed however the listing or a write ends
+    with fhand:
+        writer = None
+        if not ndjson:
+            writer = csv.DictWriter(fhand, fieldnames=inventoryFields, extrasaction='ignore')
+            writer.writeheader()
+
+        def writeCompleted(done):
+            for future in done:
+                sessionId = pending.pop(future)
+                try:
+                    serverDetails = future.result()
+                except (requests.exceptions.RequestException, ValueError, KeyError) as err:
+                    print("Session {} details failed: {} {}".format(sessionId, type(err).__name__, err))
+                    serverDetails = None
+                if serverDetails == None:
+                    inventory['Failed'] += 1
+                    continue
+                if ndjson:
+                    fhand.write(json.dumps(serverDetails) + "\n")
+                else:
+                    row = dict(serverDetails)
+                    row['Ports'] = json.dumps(row['Ports'])
+                    row['ConnectedPlayers'] = json.dumps(row['ConnectedPlayers'])
+                    writer.writerow(row)
+                inventory['Exported'] += 1
+
+        started = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+
+            def submitPage(page):
+                for x in page:
+                    if 'SessionId' not in x:        #standby servers have no connection details to export
+                        continue
+                    #Bound queued work so memory stays flat on very large fleets
+                    while len(pending) >= workers * 4:
+                        done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                        writeCompleted(done)
+                    future = pool.submit(RunAsTitle, GetActiveTitle(), FetchMultiplayerServerDetails, appchoice, x['SessionId'], debug)
+                    pending[future] = x['SessionId']
+                    inventory['Listed'] += 1
+                writeCompleted([f for f in list(pending) if f.done()])
+                print("Listed {} sessions, exported {}".format(inventory['Listed'], inventory['Exported']))
+
+            listed = ListMultiplayerServerSummaries(appchoice, debug, submitPage)
+            writeCompleted(concurrent.futures.as_completed(list(pending)))
+
+    print("Exported {} of {} sessions to {} in {:.1f} seconds ({} failed)".format(inventory['Exported'],
+        inventory['Listed'], outfile, time.monotonic() - started, inventory['Failed']))
+
+    return listed == True and inventory['Failed'] == 0
+
 # Shutsdown MPS server ; calls MultiplayerServer/ShutdownMultiplayerServer
 def ShutdownMultiplayerServer(appchoice, debug=0):   
     #Cache Multiplayer Servers Results with Session IDs
-    ListMultiplayerServers(appchoice, debug)
+    LoadSessionServers(appchoice, debug)
 
     #Manual check for mps['Bulk'] == True:
     if GetBulkConfirm()=='Y':        
@@ -219,21 +447,17 @@ def ShutdownMultiplayerServer(appchoice, debug=0):
     return shutdownStatus
 
 def ShutdownMultiplayerServerBulkRegion( appchoice , debug=0):
-    #Loop 1 - Fetch all servers to capture session IDs
-    method = "MultiplayerServer/ListMultiplayerServers"
-    data = {'BuildId': appchoice['BuildId'], 'Region': appchoice['Region'], 'PageSize': 120}
-    resp = MPSAPIHandler(method, headers, data, 0)
-
-    if resp['code'] == 200:
-        sessionList=[]
-        #Loop 2 - Fetch all sessions
-        for x in resp['data']['MultiplayerServerSummaries']:
-            if 'SessionId' in x:
-                sessionList.append(x['SessionId'])
-    else:
-        print(json.dumps(resp, sort_keys=False, indent=4))
+    #Loop 1 - Fetch all servers (every page) to capture session IDs
+    summaries = ListMultiplayerServerSummaries(appchoice, 0)
+    if summaries == None:
         return False
 
+    sessionList=[]
+    #Loop 2 - Fetch all sessions
+    for x in summaries:
+        if 'SessionId' in x:
+            sessionList.append(x['SessionId'])
+
     sessionListLength = len(sessionList)
     appchoice['SessionIds'] = sessionList
     if sessionListLength > 0:
@@ -351,32 +575,171 @@ def GetAllocateRepeatAndPause():
 
 # Allocates MPS servers; calls MultiplayerServer/RequestMultiplayerServer
 # Calls API to quantity entered by user and spaced by seconds length also entered by user
+# Ramp comes from appchoice['RampSimulate'] when set so concurrent plan steps can ramp independently
+# Batches are queued at their due time to a worker pool; allocations starting more than the tolerance
+# past their due time are flagged or shed, so a slow API shows up in the report instead of stretching the ramp
 def AllocateHandler(appchoice, repeat=1, repeatbatch=1, pause=1, debug=0):
    
-    global rampSimulate
+    ramp = appchoice.get('RampSimulate', rampSimulate)
+
+    settings = {'Timeout': GetAllocateSetting(appchoice, 'Timeout', 'timeout', allocateTimeout),
+                'Tolerance': GetAllocateSetting(appchoice, 'Tolerance', 'tolerance', allocateTolerance),
+                'Policy': GetAllocateSetting(appchoice, 'LatePolicy', 'late', allocateLatePolicy),
+                'Workers': GetAllocateSetting(appchoice, 'Workers', 'workers', allocateWorkers),
+                'Report': GetAllocateSetting(appchoice, 'Report', 'report', '')}
+    if None in settings.values():
+        return False
+
+    scheduler = {'Lock': threading.Lock(), 'Seconds': {}, 'Totals': dict.fromkeys(allocateOutcomes, 0), 'MaxLag': 0.0,
+                 'Started': time.monotonic(), 'Timeout': settings['Timeout'], 'Tolerance': settings['Tolerance'],
+                 'Policy': settings['Policy']}
+    workers = min(settings['Workers'], poolSize)
 
-    for x in range(repeat):
-        # Increment player demand if rate simulation = True
-        if rampSimulate > 0:
-            repeatbatch = repeatbatch + int(x^rampSimulate)
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        for x in range(repeat):
+            # Increment player demand if rate simulation = True
+            if ramp > 0:
+                repeatbatch = repeatbatch + int(x^ramp)
+
+            due = scheduler['Started'] + x * pause
+            if x > 0:
+                print("Next allocation in {:.1f} seconds ....".format( max(0, due - time.monotonic()) ))
+                with ProfileSpan("sleep", "sleep"):
+                    time.sleep(max(0, due - time.monotonic()))
+
+            SetMetricsGauges(Batch=x+1, BatchSize=repeatbatch, Ramp=ramp)
+
+            with ProfileSpan("batch", "batch"):
+                CountAllocation(scheduler, 'Scheduled', due, repeatbatch)
+                for y in range(repeatbatch):
+                    pool.submit(RunAsTitle, GetActiveTitle(), SendAllocation, appchoice, scheduler, x, y, due, debug)
+
+        pool.shutdown(wait=True)
+    except KeyboardInterrupt:
+        #drop the queued backlog; only allocations already in flight complete
+        print("Allocation scheduling stopped; cancelling queued allocations")
+        pool.shutdown(wait=True, cancel_futures=True)
+        totals = scheduler['Totals']
+        cancelled = totals['Scheduled'] - totals['Sent'] - totals['Shed']
+        if cancelled > 0:
+            CountAllocation(scheduler, 'Shed', time.monotonic(), cancelled)
+
+    PrintAllocateReport(scheduler, settings['Report'])
 
-        for y in range(repeatbatch):
-            sessionId = getRandomGUID()
+    return True
 
-            method = "MultiplayerServer/RequestMultiplayerServer"
-            data = {'BuildId': appchoice['BuildId'], 'SessionId': sessionId, 'PreferredRegions':  [ appchoice['Region'] ] }
-            resp = MPSAPIHandler(method, headers, data, debug)
+# Sends allocation y of batch x on a worker thread; sheds or flags it when it starts past its due time
+def SendAllocation(appchoice, scheduler, x, y, due, debug=0):
 
-            if resp['code'] != 200:
-                print(json.dumps(resp, sort_keys=False, indent=4))
-            else:
-                print("Allocation {}.{} of batch {} : Region = {}, SessionID = {}".format( x+1, y+1, x+1, appchoice['Region'], sessionId))
-        
-        print("Next allocation in {} seconds ....".format( pause ))
-        time.sleep(pause)
+    started = time.monotonic()
+    lag = started - due
+    late = lag > scheduler['Tolerance']
+    with scheduler['Lock']:
+        scheduler['MaxLag'] = max(scheduler['MaxLag'], lag)
+    SetMetricsGauges(Lag=lag)
+
+    if late and scheduler['Policy'] == 'shed':
+        CountAllocation(scheduler, 'Shed', started)
+        print("Shed allocation {}.{} of batch {} : {:.1f} seconds late".format( x+1, y+1, x+1, lag))
+        return False
+
+    CountAllocation(scheduler, 'Sent', started)
+    if late:
+        CountAllocation(scheduler, 'Late', started)
+
+    sessionId = getRandomGUID()
+
+    method = "MultiplayerServer/RequestMultiplayerServer"
+    data = {'BuildId': appchoice['BuildId'], 'SessionId': sessionId, 'PreferredRegions':  [ appchoice['Region'] ] }
+    try:
+        resp = MPSAPIHandler(method, headers, data, debug, scheduler['Timeout'])
+    except requests.exceptions.Timeout:
+        CountAllocation(scheduler, 'TimedOut', time.monotonic())
+        print("Allocation {}.{} of batch {} timed out after {} seconds".format( x+1, y+1, x+1, scheduler['Timeout']))
+        return False
+    except (requests.exceptions.RequestException, ValueError) as err:
+        CountAllocation(scheduler, 'Failed', time.monotonic())
+        print("Allocation {}.{} of batch {} failed: {}".format( x+1, y+1, x+1, err))
+        return False
+
+    with ProfileSpan(method, "print"):
+        if resp['code'] != 200:
+            CountAllocation(scheduler, 'Failed', time.monotonic())
+            print(json.dumps(resp, sort_keys=False, indent=4))
+            return False
 
+        CountAllocation(scheduler, 'Completed', time.monotonic())
+        print("Allocation {}.{} of batch {} : Region = {}, SessionID = {}{}".format( x+1, y+1, x+1, appchoice['Region'],
+            sessionId, " (late by {:.1f} seconds)".format(lag) if late else ""))
     return True
 
+# Adds count to an allocation outcome for the run second containing moment (a time.monotonic value)
+def CountAllocation(scheduler, outcome, moment, count=1):
+    second = int(moment - scheduler['Started'])
+    with scheduler['Lock']:
+        if second not in scheduler['Seconds']:
+            scheduler['Seconds'][second] = dict.fromkeys(allocateOutcomes, 0)
+        scheduler['Seconds'][second][outcome] += count
+        scheduler['Totals'][outcome] += count
+
+    if metrics['Enabled']:
+        with metrics['Lock']:
+            metrics['Allocations'][outcome] = metrics['Allocations'].get(outcome, 0) + count
+
+# Prints allocation totals and writes per second scheduled, sent & completed counts to reportfile (CSV) when given
+# Without a report file the per second table is printed for runs of up to 120 seconds
+def PrintAllocateReport(scheduler, reportfile=''):
+
+    totals = scheduler['Totals']
+    print("Allocations: {} scheduled, {} sent, {} completed, {} failed, {} timed out, {} late, {} shed; max start lag {:.1f} seconds".format(
+        totals['Scheduled'], totals['Sent'], totals['Completed'], totals['Failed'], totals['TimedOut'], totals['Late'],
+        totals['Shed'], scheduler['MaxLag']))
+
+    seconds = sorted(scheduler['Seconds'].items())
+
+    if reportfile:
+        try:
+            with open(reportfile, "w", newline='') as fhand:
+                writer = csv.writer(fhand)
+                writer.writerow(['Second'] + allocateOutcomes)
+                for second, counts in seconds:
+                    writer.writerow([second] + [counts[outcome] for outcome in allocateOutcomes])
+            print("Per second allocation report written to {}".format(reportfile))
+        except OSError as err:
+            print("Unable to write {}: {}".format(reportfile, err))
+    elif len(seconds) > 0 and seconds[-1][0] <= 120:
+        print("{:>6} ".format("Second") + " ".join("{:>9}".format(outcome) for outcome in allocateOutcomes))
+        for second, counts in seconds:
+            print("{:>6} ".format(second) + " ".join("{:>9}".format(counts[outcome]) for outcome in allocateOutcomes))
+
+# Returns an allocate scheduler setting from appchoice, then its --option flag, then the default
+# Returns None, after printing why, when the setting is not a valid value
+def GetAllocateSetting(appchoice, key, option, default):
+    value = default
+    if appchoice.get(key) != None:
+        value = appchoice[key]
+    elif options.get(option):
+        value = options[option]
+
+    try:
+        value = type(default)(value)
+    except (TypeError, ValueError):
+        print("Invalid {} setting {}".format(option, value))
+        return None
+
+    if option == 'late' and value not in allocateLatePolicies:
+        print("Invalid late setting {}; choose from {}".format(value, ", ".join(allocateLatePolicies)))
+        return None
+    if option in ('workers', 'timeout') and value <= 0:
+        print("Invalid {} setting {}; must be greater than 0".format(option, value))
+        return None
+    if option == 'tolerance' and value < 0:
+        print("Invalid tolerance setting {}; must not be negative".format(value))
+        return None
+
+    return value
+
 # Allocates MPS servers; calls MultiplayerServer/RequestMultiplayerServer
 # Calls API to quantity entered by user and spaced by seconds length also entered by user
 def RequestMultiplayerServer(appchoice, debug=0):
@@ -442,6 +805,523 @@ def UpdateBuildRegionBulk(appchoice, debug=0):
     else:
         return False        
 
+# Keeps a standby buffer sized to the observed allocation rate; calls MultiplayerServer/UpdateBuildRegion
+# Polls ListMultiplayerServers every interval seconds until duration elapses (0 runs until Ctrl+C)
+def AutoscaleHandler(appchoice, debug=0):
+
+    interval = appchoice['Interval']
+    duration = appchoice.get('Duration', 0)
+
+    #start from the region's configured standby; the start counts as an update so cooldowns apply to the first change
+    scaler = {'Rate': 0.0, 'Watermark': None, 'LastPoll': None, 'LastUpdate': time.monotonic(),
+              'Standby': FetchBuildRegionStandby(appchoice, debug)}
+
+    print("Autoscaling Build {} in {}: standby {} to {}, max servers {}, polling every {} seconds".format(
+        appchoice['BuildId'], appchoice['Region'], appchoice['MinStandby'], appchoice['MaxStandby'],
+        appchoice['MaxServers'], interval))
+    if scaler['Standby'] != None:
+        print("Current standby is {}".format(scaler['Standby']))
+
+    started = time.monotonic()
+    try:
+        while duration == 0 or time.monotonic() - started < duration:
+            summaries = ListMultiplayerServerSummaries(appchoice, debug)
+            if summaries != None:
+                AutoscaleStep(appchoice, scaler, summaries, debug)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("Autoscale stopped")
+
+    return True
+
+# Updates allocation rate estimate from one poll and applies a new standby value when warranted
+def AutoscaleStep(appchoice, scaler, summaries, debug=0):
+
+    now = time.monotonic()
+    counts = GetServerStateCounts(summaries)
+    active = counts.get('Active', 0)
+
+    #Servers that became active after the newest transition seen last poll are new allocations
+    stamps = [parseTimestamp(x['LastStateTransitionTime']) for x in summaries]
+    if scaler['Watermark'] != None:
+        allocated = 0
+        for x, stamp in zip(summaries, stamps):
+            if x['State'] == 'Active' and stamp > scaler['Watermark']:
+                allocated += 1
+        elapsed = now - scaler['LastPoll']
+        if elapsed > 0:
+            scaler['Rate'] = autoscaleSmoothing * (allocated / elapsed) + (1 - autoscaleSmoothing) * scaler['Rate']
+        stamps.append(scaler['Watermark'])
+    if len(stamps) > 0:
+        scaler['Watermark'] = max(stamps)
+    scaler['LastPoll'] = now
+
+    #without a configured standby, step from the standby servers observed on the first poll
+    if scaler['Standby'] == None:
+        scaler['Standby'] = counts.get('StandingBy', 0)
+
+    standby = GetAutoscaleStandby(appchoice, scaler, active, now)
+
+    print("Active = {}, StandingBy = {}, Initializing = {}, Rate = {:.2f}/s, Standby target = {}".format(
+        active, counts.get('StandingBy', 0), counts.get('Initializing', 0) + counts.get('Propping', 0),
+        scaler['Rate'], scaler['Standby'] if standby == None else standby))
+
+    if standby == None:
+        return False
+
+    appchoice['Max'] = appchoice['MaxServers']
+    appchoice['Standby'] = standby
+    if UpdateBuildRegionBulk(appchoice, debug):
+        scaler['Standby'] = standby
+        scaler['LastUpdate'] = now
+        return True
+
+    return False
+
+# Returns the standby servers configured for the build's region, or None when unavailable
+def FetchBuildRegionStandby(appchoice, debug=0):
+
+    method = "MultiplayerServer/GetBuild"
+    data = {'BuildId': appchoice['BuildId']}
+    resp = MPSAPIHandler(method, headers, data, debug)
+
+    if resp['code'] != 200:
+        return None
+
+    for x in resp['data'].get('RegionConfigurations', []):
+        if x['Region'] == appchoice['Region']:
+            return x.get('StandbyServers')
+
+    return None
+
+# Returns the standby value to apply, or None when hysteresis or rate limits hold the current value
+def GetAutoscaleStandby(appchoice, scaler, active, now):
+
+    desired = appchoice['MinStandby'] + int(math.ceil(scaler['Rate'] * autoscaleLeadTime))
+    desired = max(appchoice['MinStandby'], min(desired, appchoice['MaxStandby']))
+    desired = min(desired, appchoice['MaxServers'])
+
+    current = scaler['Standby']
+    delta = desired - current
+    if abs(delta) <= int(current * autoscaleHysteresis):
+        return None
+
+    cooldown = autoscaleCooldown if delta > 0 else autoscaleCooldownDown
+    if scaler['LastUpdate'] != None and now - scaler['LastUpdate'] < cooldown:
+        return None
+
+    delta = max(-autoscaleMaxStep, min(delta, autoscaleMaxStep))
+    return current + delta
+
+# Polls server states until the plan wait condition (AtLeast and/or AtMost servers in State) holds
+# Returns False when Timeout seconds pass first (0 waits indefinitely)
+def WaitForServerState(appchoice, debug=0):
+
+    state = appchoice['State']
+    atLeast = appchoice.get('AtLeast')
+    atMost = appchoice.get('AtMost')
+    timeout = appchoice.get('Timeout', 0)
+    interval = appchoice.get('Interval', 15)
+
+    started = time.monotonic()
+    while True:
+        summaries = GetCachedServerSummaries(appchoice, interval / 2, debug)
+        if summaries != None:
+            count = GetServerStateCounts(summaries).get(state, 0)
+            print("Waiting on Build {} in {}: {} {} servers".format(appchoice['BuildId'], appchoice['Region'], count, state))
+            if (atLeast == None or count >= atLeast) and (atMost == None or count <= atMost):
+                return True
+
+        if timeout > 0 and time.monotonic() - started + interval > timeout:
+            print("Timed out after {} seconds waiting for {} servers in {}".format(timeout, state, appchoice['Region']))
+            return False
+        time.sleep(interval)
+
+# Returns server summaries for a build & region, reusing a fetch younger than maxAge seconds
+# A lock per build & region lets concurrent steps share one fetch instead of racing duplicate calls
+def GetCachedServerSummaries(appchoice, maxAge, debug=0):
+
+    key = (GetActiveTitleName(), appchoice['BuildId'], appchoice['Region'])
+    with summaryCache['Lock']:
+        keyLock = summaryCache['Locks'].setdefault(key, threading.Lock())
+
+    with keyLock:
+        entry = summaryCache['Entries'].get(key)
+        if entry != None and time.monotonic() - entry[0] < maxAge:
+            return entry[1]
+
+        summaries = ListMultiplayerServerSummaries(appchoice, debug)
+        if summaries != None:
+            summaryCache['Entries'][key] = (time.monotonic(), summaries)
+        return summaries
+
+# Polls VMs & servers every interval seconds into the snapshot store; count 0 polls until Ctrl+C
+def SnapshotHandler(appchoice, debug=0):
+
+    if store['Connection'] == None and not OpenSnapshotStore(store['File']):
+        return False
+
+    count = appchoice.get('Count', 0)
+    interval = appchoice['Interval']
+    print("Recording snapshots of Build {} in {} every {} seconds to {} as run {}".format(appchoice['BuildId'],
+        appchoice['Region'], interval, store['File'], store['Run']))
+
+    polls = 0
+    try:
+        while count == 0 or polls < count:
+            started = time.monotonic()
+            vms = ListVirtualMachineSummaries(appchoice, debug)
+            servers = ListMultiplayerServerSummaries(appchoice, debug)
+            polls += 1
+            if vms != None and servers != None:
+                print("Snapshot {}: {} VMs, {} servers {}".format(polls, len(vms), len(servers), GetServerStateCounts(servers)))
+            if count == 0 or polls < count:
+                time.sleep(max(0, interval - (time.monotonic() - started)))
+    except KeyboardInterrupt:
+        print("Snapshots stopped")
+
+    return True
+
+# Sleeps for a plan hold step
+def HoldHandler(appchoice, debug=0):
+    print("Holding for {} seconds ....".format(appchoice['Seconds']))
+    time.sleep(appchoice['Seconds'])
+    return True
+
+#############################################################################
+# MPS Utility Plans
+#############################################################################
+
+# Runs a JSON plan of steps in one process; steps start once every step in their "after" list succeeded
+# Independent steps run in parallel and share authentication, the connection pool and the summary cache
+def RunPlan(planfile, debug=0):
+
+    try:
+        with open(planfile, "r") as fhand:
+            plan = json.load(fhand)
+    except (OSError, ValueError) as err:
+        print("Unable to read plan {}: {}".format(planfile, err))
+        return False
+
+    steps = LoadPlanSteps(plan)
+    if steps == None:
+        return False
+
+    results = {}
+    dependents = {}
+    waiting = {}
+    for stepId, step in steps.items():
+        waiting[stepId] = len(step['after'])
+        for before in step['after']:
+            dependents.setdefault(before, []).append(stepId)
+
+    started = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=plan.get('max_parallel', 8)) as pool:
+        running = {}
+
+        #steps without a title run against the title the plan was started with
+        planTitle = GetActiveTitle()
+
+        def submit(stepId):
+            print("Starting step {} ({})".format(stepId, steps[stepId]['op']))
+            title = titles[steps[stepId]['title']] if 'title' in steps[stepId] else planTitle
+            running[pool.submit(RunAsTitle, title, RunPlanStep, steps[stepId], debug)] = (stepId, time.monotonic())
+
+        def skip(stepId):
+            for after in dependents.get(stepId, []):
+                if after not in results:
+                    results[after] = ('skipped', 0.0)
+                    skip(after)
+
+        for stepId in steps:
+            if waiting[stepId] == 0:
+                submit(stepId)
+
+        while running:
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                stepId, stepStarted = running.pop(future)
+                try:
+                    status = future.result()
+                except Exception as err:
+                    print("Step {} raised {}: {}".format(stepId, type(err).__name__, err))
+                    status = False
+
+                results[stepId] = ('ok' if status else 'failed', time.monotonic() - stepStarted)
+                print("Finished step {}: {}".format(stepId, results[stepId][0]))
+
+                if not status:
+                    skip(stepId)
+                    continue
+                for after in dependents.get(stepId, []):
+                    waiting[after] -= 1
+                    if waiting[after] == 0 and after not in results:
+                        submit(after)
+
+    print("Plan {} finished in {:.1f} seconds".format(planfile, time.monotonic() - started))
+    for stepId in steps:
+        print("    {:<24} {:<10} {:<8} {:>8.1f}s".format(stepId, steps[stepId]['op'], results[stepId][0], results[stepId][1]))
+
+    return all(result[0] == 'ok' for result in results.values())
+
+# Validates plan steps (known ops, unique ids, known & acyclic dependencies) and applies plan defaults
+# Returns steps keyed by id in plan order, or None when the plan is invalid
+def LoadPlanSteps(plan):
+
+    steps = {}
+    outfiles = {}       #output path -> step id; concurrent steps must not write the same file
+    for index, entry in enumerate(plan.get('steps', [])):
+        step = dict(plan.get('defaults', {}))
+        step.update(entry)
+        step.setdefault('id', "step{}".format(index + 1))
+        step['after'] = list(step.get('after', []))
+
+        if step.get('op') not in planOperations:
+            print("Plan step {} has unknown op {}; choose from {}".format(step['id'], step.get('op'), ", ".join(planOperations)))
+            return None
+        if step['id'] in steps:
+            print("Plan step id {} is used more than once".format(step['id']))
+            return None
+        if 'title' in step and step['title'] not in titles:
+            print("Plan step {} uses unknown title {}".format(step['id'], step['title']))
+            return None
+        #steps run on pool threads that Ctrl+C cannot stop, so every step must end on its own
+        if step['op'] == 'autoscale' and not step.get('duration', 0) > 0:
+            print("Plan step {} needs a duration; autoscale steps cannot run until Ctrl+C".format(step['id']))
+            return None
+        if step['op'] == 'snapshot' and not step.get('count', 0) > 0:
+            print("Plan step {} needs a count; snapshot steps cannot run until Ctrl+C".format(step['id']))
+            return None
+        if step['op'] == 'wait' and not step.get('timeout', 0) > 0:
+            print("Plan step {} needs a timeout; wait steps cannot wait indefinitely".format(step['id']))
+            return None
+        if step['op'] == 'allocate':
+            settings = [GetAllocateSetting(step, option, option, default) for option, default in
+                        [('workers', allocateWorkers), ('timeout', allocateTimeout), ('tolerance', allocateTolerance), ('late', allocateLatePolicy)]]
+            if None in settings:
+                print("Plan step {} has an invalid allocate setting".format(step['id']))
+                return None
+        outfile = None
+        if step['op'] == 'inventory':
+            outfile = step.setdefault('outfile', step['id'] + ".csv")
+        elif step['op'] == 'allocate':
+            outfile = step.get('report')
+        if outfile != None:
+            path = os.path.normcase(os.path.abspath(outfile))
+            if path in outfiles:
+                print("Plan steps {} and {} both write {}".format(outfiles[path], step['id'], outfile))
+                return None
+            outfiles[path] = step['id']
+        steps[step['id']] = step
+
+    for step in steps.values():
+        for before in step['after']:
+            if before not in steps:
+                print("Plan step {} runs after unknown step {}".format(step['id'], before))
+                return None
+
+    #Kahn's algorithm; any step never reaching zero unmet dependencies is on a cycle
+    waiting = {stepId: len(step['after']) for stepId, step in steps.items()}
+    ready = [stepId for stepId in steps if waiting[stepId] == 0]
+    visited = 0
+    while ready:
+        current = ready.pop()
+        visited += 1
+        for stepId, step in steps.items():
+            if current in step['after']:
+                waiting[stepId] -= 1
+                if waiting[stepId] == 0:
+                    ready.append(stepId)
+
+    if visited != len(steps):
+        print("Plan steps {} form a dependency cycle".format(", ".join(s for s in steps if waiting[s] > 0)))
+        return None
+
+    return steps
+
+# Builds the appchoice for a plan step and runs its operation
+def RunPlanStep(step, debug=0):
+
+    debug = step.get('debug', debug)
+    bldChoice = {'Operation': step['op'], 'Debug': debug}
+
+    if step['op'] != 'hold':
+        bldChoice['BuildId'] = GetPlanBuildId(step)
+        bldChoice['Region'] = step.get('region')
+        if bldChoice['BuildId'] == None or bldChoice['Region'] == None:
+            print("Plan step {} needs build_id (or build) and region".format(step['id']))
+            return False
+
+    handler, arguments = planOperations[step['op']]
+    for argument, key, default in arguments:
+        bldChoice[key] = step.get(argument, default)
+
+    #same fallbacks as the command line, so omitted bounds never scale a region to zero
+    if step['op'] == 'autoscale':
+        if bldChoice['MaxStandby'] == None:
+            bldChoice['MaxStandby'] = bldChoice['MinStandby']
+        if bldChoice['MaxServers'] == None:
+            bldChoice['MaxServers'] = bldChoice['MaxStandby']
+    if step['op'] == 'inventory':
+        bldChoice['Workers'] = max(1, min(bldChoice['Workers'], poolSize))
+
+    with ProfileSpan(step['id'], "step"):
+        if step['op'] == 'allocate':
+            return AllocateHandler(bldChoice, bldChoice['Repeat'], bldChoice['RepeatBatch'], bldChoice['Pause'], debug)
+        return handler(bldChoice, debug)
+
+# Resolves a plan step's build_id, or its build name against the builds cached for the step's title
+def GetPlanBuildId(step):
+    if 'build_id' in step:
+        return step['build_id']
+
+    for bld in GetTitleCache().get('builds', []):
+        if bld['BuildName'] == step.get('build'):
+            return bld['BuildId']
+    return None
+
+#plan ops mapped to their handler and (plan argument, appchoice key, default) arguments
+planOperations = {
+    'allocate':  (AllocateHandler, [('batches', 'Repeat', 1), ('requests', 'RepeatBatch', 1), ('pause', 'Pause', 1),
+                                    ('ramp', 'RampSimulate', 0), ('workers', 'Workers', None), ('timeout', 'Timeout', None),
+                                    ('tolerance', 'Tolerance', None), ('late', 'LatePolicy', None), ('report', 'Report', None)]),
+    'scale':     (UpdateBuildRegionBulk, [('max', 'Max', 0), ('standby', 'Standby', 0)]),
+    'shutdown':  (ShutdownMultiplayerServerBulkRegion, []),
+    'autoscale': (AutoscaleHandler, [('min_standby', 'MinStandby', 0), ('max_standby', 'MaxStandby', None),
+                                     ('max_servers', 'MaxServers', None), ('interval', 'Interval', 30), ('duration', 'Duration', 0)]),
+    'inventory': (InventoryHandler, [('outfile', 'OutFile', None), ('workers', 'Workers', 16)]),      #outfile defaults to <id>.csv
+    'wait':      (WaitForServerState, [('state', 'State', 'StandingBy'), ('at_least', 'AtLeast', None),
+                                       ('at_most', 'AtMost', None), ('timeout', 'Timeout', 0), ('interval', 'Interval', 15)]),
+    'snapshot':  (SnapshotHandler, [('interval', 'Interval', 15), ('count', 'Count', 0)]),
+    'hold':      (HoldHandler, [('seconds', 'Seconds', 0)])
+}
+
+#############################################################################
+# MPS Utility Snapshot Store
+#############################################################################
+
+#raw rows support per server/VM history; state_counts rolls each snapshot up so time series queries stay small
+storeSchema = '''
+CREATE TABLE IF NOT EXISTS snapshots (id INTEGER PRIMARY KEY, run TEXT, ts REAL, kind TEXT, build_id TEXT, region TEXT, total INTEGER);
+CREATE TABLE IF NOT EXISTS servers (snapshot INTEGER, run TEXT, ts REAL, build_id TEXT, region TEXT, state TEXT,
+    server_id TEXT, vm_id TEXT, session_id TEXT, players INTEGER, transition REAL);
+CREATE TABLE IF NOT EXISTS vms (snapshot INTEGER, run TEXT, ts REAL, build_id TEXT, region TEXT, state TEXT, vm_id TEXT, health TEXT);
+CREATE TABLE IF NOT EXISTS state_counts (snapshot INTEGER, run TEXT, ts REAL, kind TEXT, build_id TEXT, region TEXT, state TEXT, total INTEGER);
+CREATE INDEX IF NOT EXISTS snapshots_run_ts ON snapshots (run, kind, ts);
+CREATE INDEX IF NOT EXISTS servers_run_ts ON servers (run, ts, state);
+CREATE INDEX IF NOT EXISTS servers_build_region_ts ON servers (build_id, region, ts);
+CREATE INDEX IF NOT EXISTS servers_state_ts ON servers (state, ts);
+CREATE INDEX IF NOT EXISTS servers_server ON servers (run, server_id, state, ts);
+CREATE INDEX IF NOT EXISTS vms_run_ts ON vms (run, ts, state);
+CREATE INDEX IF NOT EXISTS vms_build_region_ts ON vms (build_id, region, ts);
+CREATE INDEX IF NOT EXISTS vms_state_ts ON vms (state, ts);
+CREATE INDEX IF NOT EXISTS vms_vm ON vms (run, vm_id, state, ts);
+CREATE INDEX IF NOT EXISTS state_counts_run_ts ON state_counts (run, kind, ts, build_id, region, state, total);
+'''
+
+# Opens (creating if needed) the SQLite snapshot store shared by all threads
+def OpenSnapshotStore(storefile):
+    try:
+        connection = sqlite3.connect(storefile, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(storeSchema)
+    except sqlite3.Error as err:
+        print("Unable to open snapshot store {}: {}".format(storefile, err))
+        return False
+
+    store['Connection'] = connection
+    store['File'] = storefile
+    if not store['Run']:
+        store['Run'] = time.strftime("run-%Y%m%d-%H%M%S")
+    return True
+
+# Appends one full listing of servers or VMs as a snapshot with its per state roll up
+def RecordSnapshot(kind, appchoice, summaries):
+    if store['Connection'] == None:
+        return
+
+    now = time.time()
+    run = store['Run']
+    build = appchoice['BuildId']
+    region = appchoice['Region']
+    counts = GetServerStateCounts(summaries)
+
+    with store['Lock'], store['Connection'] as connection:
+        snapshot = connection.execute("INSERT INTO snapshots (run, ts, kind, build_id, region, total) VALUES (?, ?, ?, ?, ?, ?)",
+            (run, now, kind, build, region, len(summaries))).lastrowid
+
+        if kind == 'servers':
+            connection.executemany("INSERT INTO servers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(snapshot, run, now, build, region, x['State'], x.get('ServerId'), x.get('VmId'), x.get('SessionId'),
+                  len(x.get('ConnectedPlayers') or []), parseTimestamp(x.get('LastStateTransitionTime'))) for x in summaries])
+        else:
+            connection.executemany("INSERT INTO vms VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(snapshot, run, now, build, region, x['State'], x.get('VmId'), x.get('HealthStatus')) for x in summaries])
+
+        connection.executemany("INSERT INTO state_counts VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(snapshot, run, now, kind, build, region, state, total) for state, total in counts.items()])
+
+# Prints a snapshot store report: runs, servers|vms (mean state counts per minute) or vmready (state to state times)
+# Without a run id the most recently recorded run is reported
+def QuerySnapshotStore(report, run, debug=0):
+
+    if store['Connection'] == None and not OpenSnapshotStore(store['File']):
+        return False
+    connection = store['Connection']
+
+    if run == None and report != 'runs':
+        latest = connection.execute("SELECT run FROM snapshots ORDER BY ts DESC LIMIT 1").fetchone()
+        if latest == None:
+            print("No snapshots recorded in {}".format(store['File']))
+            return False
+        run = latest[0]
+        print("Reporting run {}".format(run))
+
+    if report == 'runs':
+        rows = connection.execute("SELECT run, kind, COUNT(*), MIN(ts), MAX(ts) FROM snapshots GROUP BY run, kind ORDER BY MIN(ts)")
+        print("{:<24} {:<8} {:>10}  {:<20} {:<20}".format("Run", "Kind", "Snapshots", "First (UTC)", "Last (UTC)"))
+        for row in rows:
+            print("{:<24} {:<8} {:>10}  {:<20} {:<20}".format(row[0], row[1], row[2], formatTimestamp(row[3]), formatTimestamp(row[4])))
+        return True
+
+    if report == 'servers' or report == 'vms':
+        #states absent from a snapshot count as zero, so divide by snapshots taken in the minute rather than averaging
+        rows = connection.execute('''
+            WITH polls AS (SELECT CAST(ts / 60 AS INTEGER) AS minute, build_id, region, COUNT(*) AS taken FROM snapshots
+                           WHERE run = ? AND kind = ? GROUP BY minute, build_id, region)
+            SELECT p.minute, p.build_id, p.region, c.state, 1.0 * SUM(c.total) / p.taken FROM state_counts c
+            JOIN polls p ON CAST(c.ts / 60 AS INTEGER) = p.minute AND c.build_id = p.build_id AND c.region = p.region
+            WHERE c.run = ? AND c.kind = ? GROUP BY p.minute, p.build_id, p.region, c.state ORDER BY p.minute, p.region, c.state''',
+            (run, report, run, report))
+        print("{:<20} {:<38} {:<16} {:<16} {:>10}".format("Minute (UTC)", "Build", "Region", "State", "Count"))
+        for row in rows:
+            print("{:<20} {:<38} {:<16} {:<16} {:>10.1f}".format(formatTimestamp(row[0] * 60), row[1], row[2], row[3], row[4]))
+        return True
+
+    if report == 'vmready':
+        fromState = options.get('from', 'Assigning')
+        toState = options.get('to', 'Running')
+        rows = connection.execute('''
+            SELECT vm_id, region, MIN(CASE WHEN state = ? THEN ts END) AS started, MIN(CASE WHEN state = ? THEN ts END) AS ready
+            FROM vms WHERE run = ? AND state IN (?, ?) GROUP BY vm_id, region''',
+            (fromState, toState, run, fromState, toState)).fetchall()
+
+        durations = sorted(row[3] - row[2] for row in rows if row[2] != None and row[3] != None and row[3] >= row[2])
+        print("{} VMs seen in {}, {} reached {}".format(sum(1 for row in rows if row[2] != None), fromState, len(durations), toState))
+        if len(durations) > 0:
+            print("{} to {} seconds: min {:.0f}, median {:.0f}, p95 {:.0f}, max {:.0f} (resolution is the poll interval)".format(
+                fromState, toState, durations[0], durations[len(durations) // 2],
+                durations[min(len(durations) - 1, int(len(durations) * 0.95))], durations[-1]))
+        return True
+
+    print("Unknown report {}; choose from runs, servers, vms or vmready".format(report))
+    return False
+
+# Formats epoch seconds as a UTC date & time
+def formatTimestamp(seconds):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(seconds))
+
 #############################################################################
 # MPS Utility Helpers
 #############################################################################
@@ -451,6 +1331,31 @@ def getRandomGUID():
     randomSession =  uuid.uuid4()
     return str(randomSession)
 
+# Parses a PlayFab timestamp (e.g. 2021-09-06T18:01:02.1234567Z) into epoch seconds
+def parseTimestamp(stamp):
+    try:
+        seconds = calendar.timegm(time.strptime(stamp[:19], "%Y-%m-%dT%H:%M:%S"))
+    except (TypeError, ValueError):
+        return 0.0
+
+    fraction = stamp[19:].lstrip('.').rstrip('Z')
+    if fraction.isnumeric():
+        seconds += float("0." + fraction)
+    return float(seconds)
+
+# Counts MPS server summaries by state (StandingBy, Active, Initializing, etc.)
+def GetServerStateCounts(summaries):
+    counts = {}
+    for x in summaries:
+        counts[x['State']] = counts.get(x['State'], 0) + 1
+    return counts
+
+# Returns command line argument at index as an int, or default when missing or not numeric
+def getNumericArgument(index, default):
+    if len(sys.argv) > index and sys.argv[index].isnumeric():
+        return int(sys.argv[index])
+    return default
+
 def getRandomGUIDEx(header, num):
     start = header
     padding = str(num)
@@ -472,24 +1377,441 @@ def getRandomGUIDEx(header, num):
 
 #Function that issues HTTP Post to PlayFab REST API
 #Optional debug param of 1 prints status code, URL and API response
-def MPSAPIHandler(method, headers, data, debug = 0):
-    baseurl = "https://" + title_id + "." + endpoint + method
-    responseAPI = requests.post(baseurl, headers = headers, json = data) 
-    responseJSON = json.loads(responseAPI.text)
+#With profiling on, times request (connect, send & wait for headers), read (body), parse and print phases
+#When the calling thread has an active title, its title id, headers, session & rate limit replace the defaults
+#Optional timeout (seconds) bounds connecting and waiting for a response; requests.exceptions.Timeout is raised
+def MPSAPIHandler(method, headers, data, debug = 0, timeout = None):
+    title = GetActiveTitle()
+    if title == None:
+        baseurl = "https://" + title_id + "." + endpoint + method
+        session = httpSession
+    else:
+        baseurl = "https://" + title['TitleId'] + "." + endpoint + method
+        headers = title['Headers']
+        session = title['Session']
+        WaitForTitleRateLimit(title)
+    if metrics['Enabled']:
+        started = RecordRequestStart()
+    try:
+        with ProfileSpan(method, "request"):
+            responseAPI = session.post(baseurl, headers = headers, json = data, stream = True, timeout = timeout) 
+        with ProfileSpan(method, "read"):
+            responseText = responseAPI.text
+        with ProfileSpan(method, "parse"):
+            responseJSON = json.loads(responseText)
+    except Exception as err:
+        if metrics['Enabled']:
+            RecordRequestEnd(method, 0, type(err).__name__, started)
+        raise
+    if metrics['Enabled']:
+        RecordRequestEnd(method, responseJSON.get('code', responseAPI.status_code), responseJSON.get('error', ''), started)
     if debug == 1:
-        print("Status code: ", responseAPI.status_code)
-        print(responseAPI.url)
-        print(json.dumps(responseJSON, indent=2))
+        with ProfileSpan(method, "print"):
+            print("Status code: ", responseAPI.status_code)
+            print(responseAPI.url)
+            print(json.dumps(responseJSON, indent=2))
     
     return responseJSON
  
+# Returns a timing span context for profiling; a shared no-op context when profiling is off
+def ProfileSpan(name, category="mps"):
+    if not profiling['Enabled']:
+        return nullSpan
+    return recordSpan(name, category)
+
+@contextlib.contextmanager
+def recordSpan(name, category):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        #list.append is atomic, so worker threads can record spans without a lock
+        spans = profiling['Spans']
+        if len(spans) < profileSpanLimit:
+            spans.append((name, category, start, time.perf_counter() - start, threading.get_ident()))
+
+# Runs an operation under cProfile & tracemalloc when profiling is on and appends results to the profile file
+# cProfile only sees the calling thread; worker threads are covered by their spans
+# Only one operation is profiled at a time; nested or concurrent operations are recorded as spans of it
+def ProfileOperation(name, func, *args):
+    if not profiling['Enabled']:
+        return func(*args)
+
+    with profiling['Lock']:
+        nested = profiling['Busy']
+        profiling['Busy'] = True
+    if nested:
+        with ProfileSpan(name, "operation"):
+            return func(*args)
+
+    firstSpan = len(profiling['Spans'])
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+
+    profiler = cProfile.Profile()
+    started = time.perf_counter()
+    profiler.enable()
+    try:
+        with ProfileSpan(name, "operation"):
+            return func(*args)
+    finally:
+        profiler.disable()
+        profiling['Busy'] = False
+        elapsed = time.perf_counter() - started
+        memory = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        #take the spans recorded since the last operation, so they are freed once written
+        spans = profiling['Spans']
+        profiling['Spans'] = []
+        #a failed write is reported without replacing the operation's result or exception
+        try:
+            WriteProfileReport(name, elapsed, profiler, memory, snapshot, spans[firstSpan:])
+        except OSError as err:
+            print("Unable to write {}: {}".format(profiling['File'], err))
+        if profiling['Trace'] != None:
+            try:
+                WriteProfileTrace(profiling['Trace'], spans)
+            except OSError as err:
+                print("Unable to write {}: {}".format(profiling['Trace'], err))
+
+# Appends span totals, top cProfile functions and top memory allocation sites for one operation
+def WriteProfileReport(name, elapsed, profiler, memory, snapshot, spans):
+
+    totals = {}
+    for span in spans:
+        key = (span[1], span[0])
+        count, total, longest = totals.get(key, (0, 0.0, 0.0))
+        totals[key] = (count + 1, total + span[3], max(longest, span[3]))
+
+    stream = io.StringIO()
+    stream.write("==== {} ({:.3f} seconds) ====\n\n".format(name, elapsed))
+    stream.write("{:<10} {:<48} {:>8} {:>12} {:>12} {:>12}\n".format("Category", "Span", "Count", "Total (s)", "Mean (ms)", "Max (ms)"))
+    for key, value in sorted(totals.items(), key=lambda item: -item[1][1]):
+        count, total, longest = value
+        stream.write("{:<10} {:<48} {:>8} {:>12.3f} {:>12.2f} {:>12.2f}\n".format(key[0], key[1][:48], count, total,
+            1000 * total / count, 1000 * longest))
+
+    if len(spans) >= profileSpanLimit:
+        stream.write("Span limit of {} reached; later spans were dropped\n".format(profileSpanLimit))
+
+    stream.write("\n")
+    pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(25)
+
+    stream.write("Memory: current {:.1f} KiB, peak {:.1f} KiB\n".format(memory[0] / 1024, memory[1] / 1024))
+    for stat in snapshot.statistics("lineno")[:10]:
+        stream.write("    {}\n".format(stat))
+    stream.write("\n")
+
+    with open(profiling['File'], "a") as fhand:
+        fhand.write(stream.getvalue())
+    print("Profile for {} appended to {}".format(name, profiling['File']))
+
+# Appends spans to a Chrome trace (open in chrome://tracing or https://ui.perfetto.dev)
+# Uses the JSON array trace format, whose closing ] is optional, so each operation only appends its own events
+def WriteProfileTrace(tracefile, spans):
+    mode = "a" if profiling['TraceStarted'] else "w"
+    with open(tracefile, mode) as fhand:
+        if mode == "w":
+            fhand.write("[\n")
+        for name, category, start, duration, thread in spans:
+            event = {'name': name, 'cat': category, 'ph': 'X', 'pid': os.getpid(), 'tid': thread,
+                     'ts': round((start - profiling['Origin']) * 1000000), 'dur': round(duration * 1000000)}
+            fhand.write(json.dumps(event) + ",\n")
+    profiling['TraceStarted'] = True
+
+# Counts a request as in flight for live metrics; returns its start time
+def RecordRequestStart():
+    with metrics['Lock']:
+        metrics['InFlight'] += 1
+    return time.perf_counter()
+
+# Records completion of a request by method, response code & error name for live metrics
+def RecordRequestEnd(method, code, error, started):
+    duration = time.perf_counter() - started
+    now = time.monotonic()
+    with metrics['Lock']:
+        metrics['InFlight'] -= 1
+
+        key = (GetActiveTitleName(), method, str(code), error)
+        metrics['Requests'][key] = metrics['Requests'].get(key, 0) + 1
+
+        if method not in metrics['Durations']:
+            metrics['Durations'][method] = {'Buckets': [0] * len(metricsBuckets), 'Sum': 0.0, 'Count': 0}
+        histogram = metrics['Durations'][method]
+        for index, bound in enumerate(metricsBuckets):
+            if duration <= bound:
+                histogram['Buckets'][index] += 1
+        histogram['Sum'] += duration
+        histogram['Count'] += 1
+
+        recent = metrics['Recent']
+        recent.append(now)
+        while recent[0] < now - metricsRateWindow:
+            recent.popleft()
+
+# Updates allocate progress gauges (Batch, BatchSize, Ramp) for live metrics
+def SetMetricsGauges(**gauges):
+    if metrics['Enabled']:
+        with metrics['Lock']:
+            metrics.update(gauges)
+
+# Escapes an OpenMetrics label value
+def metricsLabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# Renders live metrics in OpenMetrics text exposition format
+def GetMetricsText():
+    lines = []
+    with metrics['Lock']:
+        now = time.monotonic()
+        recent = sum(1 for stamp in metrics['Recent'] if stamp >= now - metricsRateWindow)
+
+        lines.append("# TYPE mps_requests_in_flight gauge")
+        lines.append("# HELP mps_requests_in_flight PlayFab API requests awaiting a response.")
+        lines.append("mps_requests_in_flight {}".format(metrics['InFlight']))
+
+        lines.append("# TYPE mps_requests counter")
+        lines.append("# HELP mps_requests PlayFab API requests completed by title, method, response code and error.")
+        for (title, method, code, error), count in sorted(metrics['Requests'].items()):
+            lines.append('mps_requests_total{{title="{}",method="{}",code="{}",error="{}"}} {}'.format(metricsLabel(title),
+                metricsLabel(method), metricsLabel(code), metricsLabel(error), count))
+
+        lines.append("# TYPE mps_requests_per_second gauge")
+        lines.append("# HELP mps_requests_per_second Requests completed per second over the last {} seconds.".format(metricsRateWindow))
+        lines.append("mps_requests_per_second {:.3f}".format(recent / metricsRateWindow))
+
+        lines.append("# TYPE mps_request_duration_seconds histogram")
+        lines.append("# UNIT mps_request_duration_seconds seconds")
+        lines.append("# HELP mps_request_duration_seconds PlayFab API request latency by method.")
+        for method, histogram in sorted(metrics['Durations'].items()):
+            label = metricsLabel(method)
+            for bound, count in zip(metricsBuckets, histogram['Buckets']):
+                lines.append('mps_request_duration_seconds_bucket{{method="{}",le="{}"}} {}'.format(label, bound, count))
+            lines.append('mps_request_duration_seconds_bucket{{method="{}",le="+Inf"}} {}'.format(label, histogram['Count']))
+            lines.append('mps_request_duration_seconds_sum{{method="{}"}} {:.6f}'.format(label, histogram['Sum']))
+            lines.append('mps_request_duration_seconds_count{{method="{}"}} {}'.format(label, histogram['Count']))
+
+        lines.append("# TYPE mps_allocate_batch gauge")
+        lines.append("# HELP mps_allocate_batch Current allocate batch number.")
+        lines.append("mps_allocate_batch {}".format(metrics['Batch']))
+        lines.append("# TYPE mps_allocate_batch_size gauge")
+        lines.append("# HELP mps_allocate_batch_size Allocations in the current batch after ramp simulation.")
+        lines.append("mps_allocate_batch_size {}".format(metrics['BatchSize']))
+        lines.append("# TYPE mps_allocate_ramp gauge")
+        lines.append("# HELP mps_allocate_ramp Ramp simulation level (0=OFF, 1=LOW, 2=MED, 3=HIGH).")
+        lines.append("mps_allocate_ramp {}".format(metrics['Ramp']))
+
+        lines.append("# TYPE mps_allocations counter")
+        lines.append("# HELP mps_allocations Allocations by scheduler outcome (Scheduled, Sent, Completed, Failed, TimedOut, Late, Shed).")
+        for outcome, count in sorted(metrics['Allocations'].items()):
+            lines.append('mps_allocations_total{{outcome="{}"}} {}'.format(outcome, count))
+        lines.append("# TYPE mps_allocate_start_lag_seconds gauge")
+        lines.append("# UNIT mps_allocate_start_lag_seconds seconds")
+        lines.append("# HELP mps_allocate_start_lag_seconds How far past its due time the latest allocation started.")
+        lines.append("mps_allocate_start_lag_seconds {:.3f}".format(metrics['Lag']))
+
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+# Serves GET /metrics for Prometheus scrapes
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = GetMetricsText().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/openmetrics-text; version=1.0.0; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return      #keep scrapes out of the console output
+
+# Starts the metrics endpoint on a daemon thread; address is [host:]port
+def StartMetricsServer(address):
+    host, _, port = address.rpartition(":")
+    if not port.isnumeric():
+        print("Invalid metrics address {}".format(address))
+        return False
+
+    try:
+        server = http.server.ThreadingHTTPServer((host or "127.0.0.1", int(port)), MetricsRequestHandler)
+    except OSError as err:
+        print("Unable to start metrics endpoint on {}: {}".format(address, err))
+        return False
+
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    metrics['Enabled'] = True
+    print("Serving metrics at http://{}:{}/metrics".format(host or "127.0.0.1", port))
+    return True
+
+# Returns the title active on the calling thread, or None for the default title
+def GetActiveTitle():
+    return getattr(activeTitle, 'Title', None)
+
+# Returns the active title's name; the default title is named "default"
+def GetActiveTitleName():
+    title = GetActiveTitle()
+    return "default" if title == None else title['Name']
+
+# Returns the active title's cache of builds, VMs & servers; the default title uses the global mps dictionary
+def GetTitleCache():
+    title = GetActiveTitle()
+    return mps if title == None else title['Cache']
+
+# Runs func with title active on the calling thread (None selects the default title)
+def RunAsTitle(title, func, *args):
+    previous = GetActiveTitle()
+    activeTitle.Title = title
+    try:
+        return func(*args)
+    finally:
+        activeTitle.Title = previous
+
+# Runs func concurrently once per named title ("all" selects every configured title); True if all succeed
+def RunForTitles(names, func, *args):
+
+    if names == ['all']:
+        names = list(titles)
+    for name in names:
+        if name not in titles:
+            print("Unknown title {}; configured titles are {}".format(name, ", ".join(titles) or "none"))
+            return False
+
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(names)) as pool:
+        futures = {pool.submit(RunAsTitle, titles[name], func, *args): name for name in names}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results[futures[future]] = future.result() == True
+            except Exception as err:
+                print("Title {} raised {}: {}".format(futures[future], type(err).__name__, err))
+                results[futures[future]] = False
+
+    for name in names:
+        print("Title {}: {}".format(name, "succeeded" if results[name] else "failed"))
+    return all(results.values())
+
+# Spaces API calls for a title so they never exceed its rate_limit (requests per second, 0 is unlimited)
+def WaitForTitleRateLimit(title):
+    if title['RateLimit'] <= 0:
+        return
+
+    with title['Lock']:
+        now = time.monotonic()
+        slot = max(now, title['NextSend'])
+        title['NextSend'] = slot + 1.0 / title['RateLimit']
+
+    if slot > now:
+        time.sleep(slot - now)
+
+# Returns a build's id when value names a build cached for the active title, otherwise value unchanged
+def ResolveBuildId(value):
+    for bld in GetTitleCache().get('builds', []):
+        if bld['BuildName'] == value:
+            return bld['BuildId']
+    return value
+
+# Starts the background thread that keeps interactive menus supplied with fresh builds, VMs & servers
+def StartPrefetch():
+    threading.Thread(target=PrefetchWorker, name="prefetch", daemon=True).start()
+
+# Refreshes prefetched lists every prefetchInterval seconds, or sooner when woken
+def PrefetchWorker():
+    while True:
+        prefetch['Wake'].wait(prefetchInterval)
+        prefetch['Wake'].clear()
+        if prefetch['Paused'].is_set():
+            continue
+        try:
+            RefreshPrefetch()
+        except (requests.exceptions.RequestException, ValueError, KeyError):
+            pass        #transient failures are retried on the next refresh
+
+# Refreshes builds and the VMs & servers of each recent selection, stopping early when an operation starts
+def RefreshPrefetch():
+
+    ListBuildSettings(0)
+
+    for selection in list(prefetch['Selections']):
+        if prefetch['Paused'].is_set():
+            return
+        vms = FetchVirtualMachineList(selection)
+        if prefetch['Paused'].is_set():
+            return
+        servers = FetchServerList(selection)
+        if vms != None and servers != None:
+            with prefetch['Lock']:
+                prefetch['Entries'][(selection['BuildId'], selection['Region'])] = {'Fetched': time.monotonic(),
+                    'vms': vms, 'servers': servers}
+
+# Keeps a build & region selection warm from the next refresh on
+def SelectPrefetch(appchoice):
+    selection = {'BuildId': appchoice['BuildId'], 'Region': appchoice['Region']}
+    with prefetch['Lock']:
+        if selection in prefetch['Selections']:
+            prefetch['Selections'].remove(selection)
+        prefetch['Selections'].insert(0, selection)
+        del prefetch['Selections'][prefetchRecent:]
+
+# Pauses background refreshes while an operation runs; the menu loop never waits on a refresh
+@contextlib.contextmanager
+def PausePrefetch():
+    prefetch['Paused'].set()
+    try:
+        yield
+    finally:
+        prefetch['Paused'].clear()
+
+# Drops prefetched lists for a selection after an operation changes its servers and triggers a refresh
+def InvalidatePrefetch(appchoice):
+    with prefetch['Lock']:
+        prefetch['Entries'].pop((appchoice['BuildId'], appchoice['Region']), None)
+    prefetch['Wake'].set()
+
+# Returns prefetched 'vms' or 'servers' for a selection when younger than prefetchMaxAge, otherwise None
+def GetPrefetched(appchoice, kind):
+    with prefetch['Lock']:
+        entry = prefetch['Entries'].get((appchoice['BuildId'], appchoice['Region']))
+    if entry == None or time.monotonic() - entry['Fetched'] > prefetchMaxAge:
+        return None
+    return entry[kind]
+
+# Caches servers for a session menu, using prefetched servers when fresh
+def LoadSessionServers(appchoice, debug=0):
+    servers = GetPrefetched(appchoice, 'servers')
+    if servers == None:
+        return ListMultiplayerServers(appchoice, debug)
+    GetTitleCache()['servers'] = servers
+    return True
+
+# Prints VMs or servers, prefetched when fresh, otherwise fetched by lister (ListVirtualMachines or ListMultiplayerServers)
+def ListPrefetched(appchoice, kind, lister, debug=0):
+    cached = GetPrefetched(appchoice, kind)
+    if cached == None:
+        if not lister(appchoice, debug):
+            return False
+        cached = GetTitleCache()[kind]
+    GetTitleCache()[kind] = cached
+    print(json.dumps(cached, indent=2))
+    print("{} {}".format(len(cached), kind))
+    return True
+
 # Defines global MPS dictionary object
 def GetAppSelection():
 
     appselection = {}
 
+    #the prefetch thread may replace the build list, so index one snapshot of it throughout
+    builds = mps["builds"]
+
     bldIndex = 0
-    for bld in mps["builds"]:
+    for bld in builds:
         print("[{}] - {} ({})".format(bldIndex, bld['BuildName'], bld['BuildId']))
         bldIndex += 1
     
@@ -504,13 +1826,13 @@ def GetAppSelection():
 
     bldNum = int(bldChoice)
     if bldNum in range(bldIndex):
-        print( "Build ", mps["builds"][bldNum]['BuildName'], " Selected")
-        appselection['BuildName'] = mps["builds"][bldNum]['BuildName']
-        appselection['BuildId'] = mps["builds"][bldNum]['BuildId']
+        print( "Build ", builds[bldNum]['BuildName'], " Selected")
+        appselection['BuildName'] = builds[bldNum]['BuildName']
+        appselection['BuildId'] = builds[bldNum]['BuildId']
 
     regIndex = 0          
-    for reg in mps["builds"][bldNum]['Regions']:
-        print("[{}] - {} ".format(regIndex, mps["builds"][bldNum]['Regions'][regIndex]))
+    for reg in builds[bldNum]['Regions']:
+        print("[{}] - {} ".format(regIndex, builds[bldNum]['Regions'][regIndex]))
         regIndex += 1
     
     regionChoice = input("Choose a region: ")
@@ -524,8 +1846,8 @@ def GetAppSelection():
 
     regNum = int(regionChoice)
     if regNum in range(regIndex):
-        print( "Region ", mps["builds"][bldNum]['Regions'][regNum], " Selected")
-        appselection['Region'] = mps["builds"][bldNum]['Regions'][regNum]
+        print( "Region ", builds[bldNum]['Regions'][regNum], " Selected")
+        appselection['Region'] = builds[bldNum]['Regions'][regNum]
 
     return appselection
 
@@ -590,7 +1912,8 @@ def authUtility():
     data = {}
     resp = MPSAPIHandler(method, headers, data)
     if resp['code'] == 200:
-        headers['X-EntityToken'] = resp['data']['EntityToken']
+        title = GetActiveTitle()
+        (headers if title == None else title['Headers'])['X-EntityToken'] = resp['data']['EntityToken']
         return True
     else:
         print(method, " Fail")
@@ -603,8 +1926,84 @@ def initUtility():
 
     return
 
+# Creates, authenticates and caches builds for every entry of the config's "titles" list
+# Entries need name, title_id & secret_key; rate_limit (requests per second) and pool_size are optional
+def initTitles(cfgResult):
+
+    for entry in cfgResult.get('titles', []):
+        session = requests.Session()
+        session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=entry.get('pool_size', poolSize)))
+
+        title = {'Name': entry['name'], 'TitleId': entry['title_id'], 'Headers': dict(headers), 'Session': session,
+                 'RateLimit': entry.get('rate_limit', 0), 'Lock': threading.Lock(), 'NextSend': 0.0, 'Cache': {}}
+        title['Headers'].pop('X-EntityToken', None)
+        title['Headers']['X-SecretKey'] = entry['secret_key']
+        titles[entry['name']] = title
+
+    if len(titles) > 0:
+        RunForTitles(list(titles), initTitle)
+
+    return
+
+# Authenticates the active title and caches its builds
+def initTitle():
+    if not authUtility():
+        return False
+    return ListBuildSettings(0)
+
+# Removes --name[=value] flags from the command line into the options dictionary and applies them
+def initOptionFlags():
+
+    arguments = [sys.argv[0]]
+    for arg in sys.argv[1:]:
+        if arg.startswith("--") and len(arg) > 2:
+            name, _, value = arg[2:].partition("=")
+            options[name] = value
+        else:
+            arguments.append(arg)
+    sys.argv[:] = arguments
+
+    if 'profile' in options or 'trace' in options:
+        profiling['Enabled'] = True
+        profiling['Origin'] = time.perf_counter()
+        if options.get('profile'):
+            profiling['File'] = options['profile']
+        if options.get('trace'):
+            profiling['Trace'] = options['trace']
+
+    if 'metrics' in options:
+        StartMetricsServer(options['metrics'] or "9464")
+
+    if options.get('run'):
+        store['Run'] = options['run']
+    if 'store' in options:
+        OpenSnapshotStore(options['store'] or store['File'])
+
+    return
+
+# Runs the command line operation, once per title when --title=name[,name] is given, then exits
 def initCommandLineOptions():
 
+    if len(sys.argv) <= 1:
+        return
+
+    if options.get('title') and "help" not in sys.argv[1] and sys.argv[1] not in offlineOperations:
+        #profiled once around all titles; cProfile allows one active profiler per process on newer Pythons
+        status = ProfileOperation(sys.argv[1], RunForTitles, options['title'].split(','), RunCommandLineOperation)
+    else:
+        status = RunCommandLineOperation()
+
+    # Return operation status
+    if status == True:
+        print(str(sys.argv), "successfully executed")
+        exit()
+    else:
+        print(str(sys.argv), "failed")
+        exit()
+
+# Parses command line arguments and runs the operation against the active title; returns operation status
+def RunCommandLineOperation():
+
     operation = ""
     bldChoice = {}
     status = 0
@@ -626,12 +2025,12 @@ def initCommandLineOptions():
                 exit()
 
             #process arguments dependent on operation
-            if operation == "allocate" or operation == "scale" or operation == "shutdown":
+            if operation == "allocate" or operation == "scale" or operation == "shutdown" or operation == "autoscale" or operation == "inventory" or operation == "snapshot":
                 
                 #Assign build choice object
                 if len(sys.argv[2]) > 0:
                     if sys.argv[2].isprintable():
-                        bldChoice['BuildId'] = sys.argv[2]
+                        bldChoice['BuildId'] = ResolveBuildId(sys.argv[2])
                 if len(sys.argv[3]) > 0:
                     if sys.argv[3].isprintable():
                         bldChoice['Region'] = sys.argv[3]
@@ -675,16 +2074,16 @@ def initCommandLineOptions():
                 bldChoice['Pause'] = pause
                 bldChoice['RampSimulate'] = rampSimulate
                 bldChoice['Debug'] = debug
-                status = AllocateHandler (bldChoice, repeat, repeatbatch, pause, debug )
+                status = ProfileOperation(operation, AllocateHandler, bldChoice, repeat, repeatbatch, pause, debug )
 
             #######################################################
             if operation == "scale":
 
                 if operation == "scale":
                     if sys.argv[4].isnumeric():
-                        max = int(sys.argv[4])
+                        maxservers = int(sys.argv[4])
                     else:
-                        max = 0
+                        maxservers = 0
 
                 if len(sys.argv[5]) > 0:
                     if sys.argv[5].isnumeric():
@@ -699,9 +2098,9 @@ def initCommandLineOptions():
                         debug = 1
 
                 bldChoice['Standby'] = standby  
-                bldChoice['Max'] = max
+                bldChoice['Max'] = maxservers
                 bldChoice['Debug'] = debug
-                status = UpdateBuildRegionBulk( bldChoice, debug )
+                status = ProfileOperation(operation, UpdateBuildRegionBulk, bldChoice, debug )
 
             #######################################################
             if operation == "shutdown":
@@ -711,18 +2110,50 @@ def initCommandLineOptions():
                     debug = 1
 
                 bldChoice['Debug'] = debug
-                status = ShutdownMultiplayerServerBulkRegion( bldChoice, debug )
+                status = ProfileOperation(operation, ShutdownMultiplayerServerBulkRegion, bldChoice, debug )
 
-    # Return operation status
-    if argumentLength > 1:
-        if status == True:
-            print(str(sys.argv), "successfully executed")
-            exit()
-        else:
-            print(str(sys.argv), "failed")
-            exit()
-    
-    return
+            #######################################################
+            if operation == "autoscale":
+                bldChoice['MinStandby'] = getNumericArgument(4, 0)
+                bldChoice['MaxStandby'] = getNumericArgument(5, bldChoice['MinStandby'])
+                bldChoice['MaxServers'] = getNumericArgument(6, bldChoice['MaxStandby'])
+                bldChoice['Interval'] = max(1, getNumericArgument(7, 30))
+                debug = getNumericArgument(8, 0)
+
+                bldChoice['Debug'] = debug
+                status = ProfileOperation(operation, AutoscaleHandler, bldChoice, debug )
+
+            #######################################################
+            if operation == "snapshot":
+                bldChoice['Interval'] = max(1, min(getNumericArgument(4, 15), 600))
+                bldChoice['Count'] = getNumericArgument(5, 0)
+                debug = getNumericArgument(6, 0)
+
+                bldChoice['Debug'] = debug
+                status = ProfileOperation(operation, SnapshotHandler, bldChoice, debug )
+
+            #######################################################
+            if operation == "query":
+                report = sys.argv[2] if len(sys.argv) > 2 else "runs"
+                run = sys.argv[3] if len(sys.argv) > 3 else None
+                status = QuerySnapshotStore(report, run, debug )
+
+            #######################################################
+            if operation == "run":
+                planfile = sys.argv[2] if len(sys.argv) > 2 else "plan.json"
+                debug = getNumericArgument(3, 0)
+                status = ProfileOperation(operation, RunPlan, planfile, debug )
+
+            #######################################################
+            if operation == "inventory":
+                bldChoice['OutFile'] = sys.argv[4] if len(sys.argv) > 4 else "inventory.csv"
+                bldChoice['Workers'] = max(1, min(getNumericArgument(5, 16), poolSize))
+                debug = getNumericArgument(6, 0)
+
+                bldChoice['Debug'] = debug
+                status = ProfileOperation(operation, InventoryHandler, bldChoice, debug )
+
+    return status
 
 
 # Initializes utility configuration; dependency on mpsutility.cfg file
@@ -773,18 +2204,49 @@ def callHelpInstructions():
     print("     mpsutility allocate build_id region batch[0:100000] requests[0:100] ramp[0:3] pauseCount[1:600] debug[1|0]")
     print("     mpsutility scale build_id region max[0:100000] standby[0:100000] debug[1|0]")
     print("     mpsutility shutdown build_id region debug[1|0]")
+    print("     mpsutility autoscale build_id region minStandby[0:100000] maxStandby[0:100000] max[0:100000] interval[1:600] debug[1|0]")
+    print("     mpsutility inventory build_id region outfile[.csv|.ndjson] workers[1:64] debug[1|0]")
+    print("     mpsutility run plan.json debug[1|0]")
+    print("     mpsutility snapshot build_id region interval[1:600] count[0:100000] debug[1|0]")
+    print("     mpsutility query runs|servers|vms|vmready [run_id (default latest run)]")
+    print("")
+    print("Options can be added to any command line or to the interactive launch")
+    print("     --profile[=file]    cProfile, tracemalloc and span timings per operation (default mpsutility.profile.txt)")
+    print("     --trace=file.json   also writes a Chrome trace timeline of the spans (implies --profile)")
+    print("     --metrics[=[host:]port]  serves OpenMetrics at http://host:port/metrics (default 127.0.0.1:9464)")
+    print("     --store[=file]      appends every full VM & server listing to a SQLite store (default mpsutility.db)")
+    print("     --run=name          run id for stored snapshots (default run-YYYYMMDD-HHMMSS)")
+    print("     --from=state --to=state  VM states timed by query vmready (default Assigning to Running)")
+    print("     --title=name[,name]|all  runs the operation concurrently for each title listed under titles in mpsutility.json")
+    print("                         build_id may then be a build name, resolved in each title")
+    print("     --workers=16 --timeout=10 --tolerance=5 --late=flag|shed  allocate scheduler: concurrent requests,")
+    print("                         per request timeout, seconds an allocation may start late, and whether late ones are sent")
+    print("     --report=file.csv   per second scheduled, sent, completed, failed, timed out, late and shed allocations")
     print("")
     print(      "Example 1: python mpsutility.py allocate a780dff0-4f11-4cb1-a449-75ac1207616d WestUS 200 10 3 2 0")
     print(      "Example 2: python mpsutility.py shutdown a780dff0-4f11-4cb1-a449-75ac1207616d WestUS 1")
     print(      "Example 3: python mpsutility.py scale a780dff0-4f11-4cb1-a449-75ac1207616d WestUS 800 200 0")
+    print(      "Example 4: python mpsutility.py autoscale a780dff0-4f11-4cb1-a449-75ac1207616d WestUS 20 400 800 15 0")
+    print(      "Example 5: python mpsutility.py inventory a780dff0-4f11-4cb1-a449-75ac1207616d WestUS sessions.csv 16 0")
+    print(      "Example 6: python mpsutility.py run plan.json 0")
+    print(      "Example 7: python mpsutility.py snapshot a780dff0-4f11-4cb1-a449-75ac1207616d WestUS 15 0 0 --run=ramp1")
+    print(      "Example 8: python mpsutility.py query servers ramp1")
     print("")
-    print("The utility enables 3 operations: allocate, scale and shutdown")
+    print("The utility enables 8 operations: allocate, scale, shutdown, autoscale, inventory, run, snapshot and query")
     print("In example #1, the allocate operaton issues 200 batch requests with")
     print("10 requests per batch with 3 seconds between allocations for a given build")
     print("and region producing a total of 2,000 game server allocations.")
     print("The second to last param is a rate simulator, options are 0=OFF, 1=LOW, 2=MED and 3=HIGH")
     print("The higher the rate simulator #, the steeper the player demand ramp up curve")
     print("The limits for batch, standby, max are 100,000 and the limits for requests are 100 representing 100 requests per batch")
+    print("In example #4, autoscale runs until Ctrl+C, polling servers every 15 seconds and keeping")
+    print("20 standby servers plus enough to cover 2 minutes of the observed allocation rate, up to 400")
+    print("standby and 800 max servers")
+    print("In example #5, inventory writes IP, FQDN and ports of every active session using 16 workers")
+    print("In example #6, run executes the steps of plan.json, running independent steps in parallel")
+    print("Plan ops are allocate, scale, shutdown, autoscale, inventory, wait, snapshot and hold (see README)")
+    print("In example #7, snapshot records VMs and servers every 15 seconds to mpsutility.db under run ramp1")
+    print("In example #8, query prints mean server state counts per minute for run ramp1")
     print("")
 
 #Defines main console loop and processes user input
@@ -792,7 +2254,19 @@ def MainLoop():
 
     global title_id
 
+    initOptionFlags()
+
+    #offline operations read local files only, so skip configuration and authentication
+    if len(sys.argv) > 1 and sys.argv[1] in offlineOperations:
+        initCommandLineOptions()
+
     cfgResult = initConfig()
+
+    #a config with only a "titles" list uses its first title as the default
+    if not cfgResult.get('title_id') and len(cfgResult.get('titles', [])) > 0:
+        cfgResult['title_id'] = cfgResult['titles'][0]['title_id']
+        cfgResult['secret_key'] = cfgResult['titles'][0]['secret_key']
+
     title_id = cfgResult['title_id']                    #change title id to titles title id
     headers['X-SecretKey'] = cfgResult['secret_key']    #change X-SecretKey to titles secret key
 
@@ -800,8 +2274,13 @@ def MainLoop():
     
     initUtility()
 
+    initTitles(cfgResult)
+
     initCommandLineOptions()
 
+    if authResult == True:
+        StartPrefetch()
+
     firstRun = True
 
     while authResult == True:
@@ -812,6 +2291,7 @@ def MainLoop():
                 break
 
         callMenu()
+        prefetch['Wake'].set()      #refresh while the menu is read
 
         choice = 0
         while choice not in range(1,10):
@@ -821,37 +2301,43 @@ def MainLoop():
 
         if choice in range(2,8):
             appchoice = GetAppSelection()                
+            SelectPrefetch(appchoice)
 
-        if choice == 0 :     #List Command Line Arguments
-            callHelpInstructions()
+        #hold off background refreshes so they don't skew the operation's rate limits, metrics & profile
+        with PausePrefetch():
+            if choice == 0 :     #List Command Line Arguments
+                callHelpInstructions()
 
-        elif choice == 1:     #List Build Settings
-            ListBuildSettings(1)
+            elif choice == 1:     #List Build Settings
+                ProfileOperation("ListBuildSettings", ListBuildSettings, 1)
 
-        elif choice == 2:   #List Virtual Machines
-            ListVirtualMachines(appchoice, 1)
+            elif choice == 2:   #List Virtual Machines
+                ProfileOperation("ListVirtualMachines", ListPrefetched, appchoice, 'vms', ListVirtualMachines, 0)
                 
-        elif choice == 3:   #List Multiplayer Servers
-            ListMultiplayerServers(appchoice, 1)
+            elif choice == 3:   #List Multiplayer Servers
+                ProfileOperation("ListMultiplayerServers", ListPrefetched, appchoice, 'servers', ListMultiplayerServers, 0)
 
-        elif choice == 4:   #Get Multiplayer Server Details
-            GetMultiplayerServerDetails(appchoice, 0)
+            elif choice == 4:   #Get Multiplayer Server Details
+                ProfileOperation("GetMultiplayerServerDetails", GetMultiplayerServerDetails, appchoice, 0)
 
-        elif choice == 5:   #Request Multiplayer Server
-            RequestMultiplayerServer(appchoice, 0)
+            elif choice == 5:   #Request Multiplayer Server
+                ProfileOperation("RequestMultiplayerServer", RequestMultiplayerServer, appchoice, 0)
 
-        elif choice == 6:   #Shutdown Multiplayer Server
-            ShutdownMultiplayerServer(appchoice)
+            elif choice == 6:   #Shutdown Multiplayer Server
+                ProfileOperation("ShutdownMultiplayerServer", ShutdownMultiplayerServer, appchoice)
 
-        elif choice == 7:   #Update Build Region
-            UpdateBuildRegion(appchoice, 1)
+            elif choice == 7:   #Update Build Region
+                ProfileOperation("UpdateBuildRegion", UpdateBuildRegion, appchoice, 1)
 
-        elif choice == 8:   #List headers
-            print(json.dumps(headers, indent=3))
+            elif choice == 8:   #List headers
+                print(json.dumps(headers, indent=3))
         
-        elif choice == 9:   #Exit application
-            print("Exiting application")
-            quit()
+            elif choice == 9:   #Exit application
+                print("Exiting application")
+                quit()
+
+        if choice in range(5,8):    #allocations, shutdowns & limit changes make prefetched servers stale
+            InvalidatePrefetch(appchoice)
 
         firstRun = False
 